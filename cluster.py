@@ -1,17 +1,52 @@
 import re
 import os
+import sys
+import glob
+import json
+import shutil
+import tempfile
+import hashlib
 import argparse
+import importlib.util
 import subprocess
-import pandas as pd
+from functools import lru_cache
+from collections import namedtuple, deque, Counter
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.feather as feather
+
+
+# a default list of features to exclude from clustering. Each pattern is anchored at the start of the column name;
+# morphological features must match exactly, stains are matched by prefix (e.g. DNA_1, AF488, A488_background)
+FEATURES_TO_REMOVE = (r'\AX_centroid\Z', r'\AY_centroid\Z', # morphological features
+                    r'\Acolumn_centroid\Z', r'\Arow_centroid\Z', 
+                    r'\AArea\Z', r'\AMajorAxisLength\Z', 
+                    r'\AMinorAxisLength\Z', r'\AEccentricity\Z', 
+                    r'\ASolidity\Z', r'\AExtent\Z', r'\AOrientation\Z', 
+                    r'\ADNA', r'\AHoechst', r'\ADAP', # DNA stain
+                    r'\AAF', # autofluorescence
+                    r'\AA\d{3}') # secondary antibody staining only (it has to have 3 digits after)
+
+# all features to exclude fused into a single regex, compiled once at import
+_EXCLUDE_RE = re.compile('|'.join(FEATURES_TO_REMOVE))
+
+CELL_ID = 'CellID' # column name holding cell IDs
+
+# immutable settings for clustering one input file, built once from the arguments and passed to each step
+Config = namedtuple('Config', ['input', 'output', 'markers', 'verbose', 'neighbors', 'num_threads', 'method', 'transform', 'rpy2',
+                               'clean_data_file', 'cells_file', 'clusters_file', 'qc_config_file'])
 
 
 '''
 Parse arguments.
-Input file is required.
+An input file, or a glob pattern matching several input files, is required.
 '''
 def parseArgs():
     parser = argparse.ArgumentParser(description='Cluster cell types using mcmicro marker expression data.')
-    parser.add_argument('-i', '--input', help="Input CSV of mcmicro marker expression data for cells", type=str, required=True)
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-i', '--input', help="Input CSV of mcmicro marker expression data for cells", type=str)
+    inputs.add_argument('-I', '--inputs', help='A glob pattern (quoted) matching several input CSVs to cluster in one run. The files must have unique names. While FastPG runs on one file, the next ones are cleaned in NUM_THREADS-1 worker processes (at least one), so the CPUs used stay close to NUM_THREADS. The qc config is written per file to qc/{name}-config.yml.', type=str)
     parser.add_argument('-o', '--output', help='The directory to which output files will be saved', type=str, required=False)
     parser.add_argument('-m', '--markers', help='A text file with a marker on each line to specify which markers to use for clustering', type=str, required=False)
     parser.add_argument('-v', '--verbose', help='Flag to print out progress of script', action="store_true", required=False)
@@ -21,7 +56,28 @@ def parseArgs():
     parser.add_argument('-y', '--config', help='A yaml config file that states whether the input data should be log/logicle transformed.', type=str, required=False)
     parser.add_argument('--force-transform', help='Log transform the input data. If omitted, and --no-transform is omitted, log transform is only performed if the max value in the input data is >1000.', action='store_true', required=False)
     parser.add_argument('--no-transform', help='Do not perform Log transformation on the input data. If omitted, and --force-transform is omitted, log transform is only performed if the max value in the input data is >1000.', action='store_true', required=False)
+    parser.add_argument('--cache', help='Reuse the results of a previous run with the same input data and parameters, stored in a .cache directory in the output directory. Costs an extra read of each input file to fingerprint it.', action='store_true', required=False)
+    parser.add_argument('--rpy2', help='Run FastPG in an embedded R session through rpy2 instead of calling Rscript. Requires rpy2 and pandas.', action='store_true', required=False)
     args = parser.parse_args()
+
+    if args.num_threads < 1:
+        parser.error('--num-threads must be at least 1')
+
+    # expand the glob of input files
+    if args.inputs is not None:
+        args.inputs = sorted(glob.glob(args.inputs))
+        if not args.inputs:
+            parser.error('no input files match the --inputs pattern')
+
+        # output file names are prefixed with the input file name, so they must be unique
+        duplicates = sorted(name for name, count in Counter(getDataName(f) for f in args.inputs).items() if count > 1)
+        if duplicates:
+            parser.error(f'input files matching the --inputs pattern must have unique names, found duplicates of: {", ".join(duplicates)}')
+
+    # the rpy2 backend has optional dependencies, check for them up front rather than failing after cleaning
+    if args.rpy2 and not all(importlib.util.find_spec(module) for module in ('rpy2', 'pandas')):
+        parser.error('--rpy2 requires the rpy2 and pandas packages, install them with: pip install rpy2 pandas')
+
     return args
 
 
@@ -29,18 +85,15 @@ def parseArgs():
 Get the path to the directory where this script is located and return it.
 '''
 def get_path():
-    full_path = os.path.realpath(__file__)
-    path_list = full_path.split('/')[:-1]
-    s = '/'
-    return s.join(path_list)
+    return os.path.dirname(os.path.realpath(__file__))
 
 
 '''
 Get input data file name
 '''
 def getDataName(path):
-    fileName = path.split('/')[-1] # get filename from end of input path
-    dataName = fileName[:fileName.rfind('.')] # get data name by removing extension from file name
+    fileName = os.path.basename(path) # get filename from end of input path
+    dataName = os.path.splitext(fileName)[0] # get data name by removing extension from file name
     return dataName
 
 
@@ -49,19 +102,16 @@ Get markers to use for clustering from a text file where each marker is on a lin
 Returns a list of markers to use for clustering.
 '''
 def get_markers(markers_file):
-    markers = [] # list of markers in file
-
-    # read markers from file
-    f = open(markers_file, 'r')
-    for line in f:
-        markers.append(line.strip())
+    # read markers from file, skipping blank lines
+    with open(markers_file, 'r') as f:
+        markers = [line.strip() for line in f.read().splitlines() if line.strip()]
 
     return markers
 
 
 '''
 Clean data in input file.
-NOTE: Currently we are doing this with pandas however, using csv might be faster, or numpy.
+Only the columns that are kept are parsed, using pyarrow's multithreaded CSV reader.
 
 Exclude the following data from clustering:
     - X_centroid, …, Extent, Orientation - morphological features
@@ -74,108 +124,201 @@ Exclude the following data from clustering:
 
 To include any of these markers in the clustering, provide their exact names in a file passed in with the '-m' flag
 '''
-def clean(input_file):
+def clean(config, use_threads=True):
 
-    # constants
+    if config.verbose:
+        print('Cleaning data...')
 
-    # a default list of features to exclude from clustering
-    FEATURES_TO_REMOVE = ['X_centroid', 'Y_centroid', # morphological features
-                        'column_centroid', 'row_centroid', 
-                        'Area', 'MajorAxisLength', 
-                        'MinorAxisLength', 'Eccentricity', 
-                        'Solidity', 'Extent', 'Orientation', 
-                        'DNA.*', 'Hoechst.*', 'DAP.*', # DNA stain
-                        'AF.*', # autofluorescence
-                        'A\d{3}.*'] # secondary antibody staining only (iy has to have 3 digist after)
+    # read only the header so we know which columns to load. Use pyarrow so the names match what include_columns
+    # sees (e.g. a UTF-8 byte order mark is stripped)
+    with pacsv.open_csv(config.input, read_options=pacsv.ReadOptions(use_threads=False)) as reader:
+        header = reader.schema.names
+    keep_cols = compute_keep_cols(header, config.markers)
+
+    # declare column types up front instead of letting them be inferred: cell IDs are integers and markers are
+    # doubles, which is what R works in anyway, so no values are rounded
+    column_types = {col: pa.float64() for col in keep_cols}
+    column_types[CELL_ID] = pa.int64()
+
+    # load only the columns we keep, in the order given (CellID first)
+    data = pacsv.read_csv(config.input,
+                          read_options=pacsv.ReadOptions(use_threads=use_threads, block_size=8 << 20),
+                          convert_options=pacsv.ConvertOptions(include_columns=keep_cols, column_types=column_types))
+
+    # save cleaned data to feather so the R script can load it without parsing a CSV. The rpy2 backend is handed
+    # the data directly, so nothing would read the file
+    if config.rpy2:
+        if config.verbose:
+            print('Done.')
+    else:
+        feather.write_feather(data, f'{config.output}/{config.clean_data_file}', compression='uncompressed')
 
-    if args.verbose:
-        print('Cleaning data...')
+        if config.verbose:
+            print(f'Done. Cleaned data is in {config.output}/{config.clean_data_file}.')
+
+    return data
+
+
+'''
+Clean one of several input files in a worker process.
+Parsing is single threaded since the files themselves are processed in parallel. The cleaned data is only sent back
+to the main process when it is needed by the rpy2 backend, otherwise the R script reads it from the feather file.
+'''
+def clean_one(config):
+    data = clean(config, use_threads=False)
+    return data if config.rpy2 else None
+
+
+'''
+Clean input files in worker processes, yielding the cleaned files in order as each one is ready.
+While the caller runs FastPG on a yielded file, the workers clean the next ones. At most max_workers files are
+queued beyond the one being used, so cleaned tables don't pile up in memory.
+'''
+def clean_parallel(configs, max_workers):
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque()
+        for config in configs:
+            futures.append(executor.submit(clean_one, config))
+            if len(futures) > max_workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
 
-    # load csv
-    data = pd.read_csv(input_file)
 
-    # if markers provided, keep only those features and the Cell IDs. It is important that the CellID column is first.
-    if args.markers:
+'''
+Get the list of columns to keep from the input data header.
+If markers are provided, keep only those features and the Cell IDs, otherwise keep every column not matched by _EXCLUDE_RE.
+It is important that the CellID column is first.
+'''
+def compute_keep_cols(header, markers):
+    if markers:
+        markers = list(markers) # copy so the caller's (possibly cached) markers are not modified
         if CELL_ID not in markers: # add cell ID to list of columns to keep
             markers.insert(0, CELL_ID)
         elif markers.index(CELL_ID) != 0: # if cell ID column is included but not first, move it to the front
             markers.insert(0, markers.pop(markers.index(CELL_ID)))
-        data = data[markers]
-    else:
-        # find any columns in the input csv that should be excluded from clustering be default
-        # NOTE: may want to replace this with regex, it might be faster.
-        col_to_remove = []
-        cols = data.columns
-        for feature in FEATURES_TO_REMOVE:
-            r = re.compile(feature)
-            col_to_remove.extend(list(filter(r.match, cols)))
-        
-        # drop all columns that should be excluded
-        data = data.drop(columns=col_to_remove, axis=1)
+        return markers
 
-    # save cleaned data to csv
-    data.to_csv(f'{output}/{clean_data_file}', index=False)
-
-    if args.verbose:
-        print(f'Done. Cleaned data is in {output}/{clean_data_file}.csv.')
+    # find any columns in the input csv that should be excluded from clustering by default
+    return [col for col in header if not _EXCLUDE_RE.match(col)]
 
 
 '''
-Run an R script that runs FastPG. Scriptception.
+Run FastPG on the cleaned data, either in-process through rpy2 or with an R script. Scriptception.
 '''
-def runFastPG():
-    if args.verbose:
+def runFastPG(data, config):
+    if config.verbose:
         print('Running R script...')
-    
+
+    if config.rpy2:
+        modularity = runFastPGInProcess(data, config)
+    else:
+        modularity = runFastPGScript(config)
+
+    if config.verbose:
+        print(f'Modularity: {modularity}')
+        print('Done.')
+
+
+'''
+Run the FastPG R script with Rscript on the cleaned data file and return the modularity.
+'''
+def runFastPGScript(config):
     path = get_path() # get the path where the r script is located
 
     r_script = ['Rscript', f'{path}/runFastPG.r'] # use FastPG.r script
-    # pass input data file, k value, number of cpus to use for the k nearest neighbors part of clustering, output dir, cells file name, clusters file name, log transform flag
-    r_args = [f'{output}/{clean_data_file}', str(args.neighbors), str(args.num_threads), output, cells_file, clusters_file, str(args.method), transform]
+    # pass input data file, k value, number of cpus to use for the k nearest neighbors part of clustering, output dir, cells file name, clusters file name, method flag, log transform flag, qc config file
+    r_args = [f'{config.output}/{config.clean_data_file}', str(config.neighbors), str(config.num_threads), config.output,
+              config.cells_file, config.clusters_file, str(config.method), config.transform, config.qc_config_file]
 
     # Build subprocess command
     command = r_script + r_args
 
-    # run R script and get modularity from stdout 
-    modularity = subprocess.check_output(command, universal_newlines=True)
+    # run R script, streaming its stdout (forwarded to stderr under verbose) as it runs and keeping only the last line,
+    # which holds the modularity. stderr is not captured so R warnings and errors go straight to the terminal.
+    modularity = ''
+    with subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1) as p:
+        for line in p.stdout:
+            if config.verbose:
+                print(line.rstrip('\n'), file=sys.stderr, flush=True)
+            if line.strip():
+                modularity = line.strip()
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, command)
 
-    if args.verbose:
-        print(f'Modularity: {modularity}')
-        print('Done.')
+    return modularity
+
+
+'''
+Run FastPG in an embedded R session through rpy2, passing the cleaned data directly instead of through a file, and return the modularity.
+rpy2 (and pandas, for the data conversion) are only needed when the --rpy2 flag is used.
+'''
+def runFastPGInProcess(data, config):
+    import rpy2.robjects as ro
+    from rpy2.robjects import pandas2ri
+    from rpy2.robjects.conversion import localconverter
+
+    r_fastpg = _load_r_fastpg(f'{get_path()}/runFastPG.r')
+
+    # convert the arrow table to an R data frame
+    with localconverter(ro.default_converter + pandas2ri.converter):
+        r_data = ro.conversion.py2rpy(data.to_pandas())
+
+    modularity = r_fastpg(r_data, config.neighbors, config.num_threads, config.output,
+                          config.cells_file, config.clusters_file, str(config.method), config.transform, config.qc_config_file)
+    return modularity[0]
+
+
+'''
+Source the FastPG R script into the embedded R session and return its runFastPG function.
+Cached so R startup and loading FastPG's libraries is only paid once per process.
+'''
+@lru_cache(maxsize=None)
+def _load_r_fastpg(r_script):
+    import rpy2.robjects as ro
+
+    ro.r.source(r_script)
+    return ro.globalenv['runFastPG']
 
 
 '''
 Read config.yml file contents.
 '''
 def readConfig(file):
-    f = open(file, 'r')
-    lines = f.readlines()
-
-    # find line with 'transform:' in it
-    for l in lines:
-        if 'transform:' in l.strip():
-            transform = l.split(':')[-1].strip() # get last value after colon
+    # find the first line starting with 'transform:', stopping there instead of reading the whole file
+    with open(file, 'r') as f:
+        line = next((l for l in f if l.strip().startswith('transform:')), None)
 
-    return transform
+    if line is None: # default if the config does not specify a transform
+        return 'auto'
+    return line.split(':')[-1].strip() # get last value after colon
 
 
 '''
-Main.
+Parse a file with the given parser function, caching the result in-process keyed on the file's path, mtime and size,
+so a file shared by many samples is only parsed once while edits to it are still picked up.
 '''
-if __name__ == '__main__':
-    args = parseArgs() # parse arguments
+def load_cached(path, parser):
+    stat = os.stat(path)
+    return _load_cached(os.path.realpath(path), stat.st_mtime, stat.st_size, parser)
+
+
+@lru_cache(maxsize=None)
+def _load_cached(path, mtime, size, parser):
+    return parser(path)
 
-    # get user-defined output dir (strip last slash if present) or set to current
-    if args.output is None:
-        output = '.'
-    elif args.output[-1] == '/':
-        output = args.output[:-1]
-    else:
-        output = args.output
+
+'''
+Build the immutable config for clustering an input file from the parsed arguments.
+'''
+def build_config(args, input_file):
+    # get user-defined output dir (strip trailing slashes) or set to current
+    output = os.path.normpath(args.output) if args.output else '.'
 
     # get list of markers if provided
-    if args.markers is not None:
-        markers = get_markers(args.markers)
+    markers = load_cached(args.markers, get_markers) if args.markers is not None else None
+    if markers is not None and not markers: # don't silently fall back to clustering on every non-excluded column
+        sys.exit(f'error: no markers found in {args.markers}')
 
     # assess log transform parameter
     if args.force_transform and not args.no_transform:
@@ -183,21 +326,114 @@ if __name__ == '__main__':
     elif not args.force_transform and args.no_transform:
         transform = 'false'
     elif args.config is not None:
-        transform = readConfig(args.config)
+        transform = load_cached(args.config, readConfig)
     else:
         transform = 'auto'
 
-    # constants
-    CELL_ID = 'CellID' # column name holding cell IDs
-    
     # output file names
-    data_prefix = getDataName(args.input) # get the name of the input data file to add as a prefix to the output file names
-    clean_data_file = f'{data_prefix}-clean.csv' # name of output cleaned data CSV file
+    data_prefix = getDataName(input_file) # get the name of the input data file to add as a prefix to the output file names
+    clean_data_file = f'{data_prefix}-clean.feather' # name of output cleaned data feather file
     clusters_file = f'{data_prefix}-clusters.csv' # name of output CSV file that contains the mean expression of each feaute, for each cluster
     cells_file = f'{data_prefix}-cells.csv' # name of output CSV file that contains each cell ID and it's cluster assignation
-    
-    # clean input data file
-    clean(args.input)
+    # name of the qc file recording whether the data was log transformed, one per input file when several are clustered
+    qc_config_file = 'qc/config.yml' if args.inputs is None else f'qc/{data_prefix}-config.yml'
 
-    # run FastPG algorithm
-    runFastPG()
\ No newline at end of file
+    return Config(input=input_file, output=output, markers=tuple(markers) if markers is not None else None, verbose=args.verbose,
+                  neighbors=args.neighbors, num_threads=args.num_threads, method=args.method, transform=transform, rpy2=args.rpy2,
+                  clean_data_file=clean_data_file, cells_file=cells_file, clusters_file=clusters_file, qc_config_file=qc_config_file)
+
+
+'''
+Compute a fingerprint of everything that determines the clustering results of a config: the input data, the markers,
+k, the transform flag, the method flag, the default features to exclude and the code that cleans the data and runs
+FastPG (this script and the R script), so upgrading either invalidates the cache.
+BLAKE2b is used since it is fast and there is no cryptographic need.
+'''
+def fingerprint(config):
+    h = hashlib.blake2b(digest_size=16)
+    for path in (config.input, os.path.realpath(__file__), f'{get_path()}/runFastPG.r'):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    h.update(json.dumps([config.markers, config.neighbors, config.transform, config.method, _EXCLUDE_RE.pattern]).encode())
+    return h.hexdigest()
+
+
+'''
+Get the cached result files for a fingerprint, paired with where they are copied to in the output.
+'''
+def cached_files(config, key):
+    cache_dir = f'{config.output}/.cache/{key}'
+    return [(f'{cache_dir}/cells.csv', f'{config.output}/{config.cells_file}'),
+            (f'{cache_dir}/clusters.csv', f'{config.output}/{config.clusters_file}'),
+            (f'{cache_dir}/config.yml', config.qc_config_file)]
+
+
+'''
+Copy the results of a previous run with the same fingerprint into place.
+Returns False if there are no cached results.
+'''
+def restore_cached(config, key):
+    files = cached_files(config, key)
+    if not all(os.path.exists(cached) for cached, _ in files):
+        return False
+
+    os.makedirs(os.path.dirname(config.qc_config_file), exist_ok=True)
+    for cached, result in files:
+        shutil.copy(cached, result)
+
+    if config.verbose:
+        print(f'Reusing cached results for {config.input}.')
+    return True
+
+
+'''
+Save the results of a run in the cache under its fingerprint.
+The files are copied into a temporary directory that is then moved into place, so an interrupted run never leaves
+a partial cache entry behind.
+'''
+def store_cached(config, key):
+    files = cached_files(config, key)
+    cache_dir = os.path.dirname(files[0][0])
+    os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(cache_dir), prefix=f'.{key}-')
+    try:
+        for cached, result in files:
+            shutil.copy(result, os.path.join(tmp_dir, os.path.basename(cached)))
+        os.replace(tmp_dir, cache_dir)
+    except OSError: # an entry with the same fingerprint was already stored (e.g. an earlier input with identical contents), keep it
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+'''
+Main.
+'''
+def main():
+    args = parseArgs() # parse arguments
+    input_files = [args.input] if args.inputs is None else args.inputs
+    configs = [build_config(args, input_file) for input_file in input_files]
+
+    # if caching, reuse the results of previous runs with the same inputs and parameters and only process the rest
+    pending = []
+    for config in configs:
+        key = fingerprint(config) if args.cache else None
+        if key is None or not restore_cached(config, key):
+            pending.append((config, key))
+
+    if args.inputs is None:
+        # clean input data file
+        cleaned = (clean(config) for config, _ in pending)
+    else:
+        # clean the input data files in parallel, leaving one of the threads for FastPG, which runs at the same time
+        cleaned = clean_parallel([config for config, _ in pending], max(1, args.num_threads - 1))
+
+    # run FastPG algorithm on each cleaned file as it is ready, each run uses all the threads for the k nearest neighbors
+    for data, (config, key) in zip(cleaned, pending):
+        runFastPG(data, config)
+        if key is not None:
+            store_cached(config, key)
+
+
+if __name__ == '__main__':
+    main()